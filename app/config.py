@@ -1,14 +1,35 @@
+from typing import Optional
+from pydantic import model_validator
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
     DATABASE_URL: str = "sqlite:///./faces.db"
     FAISS_INDEX_PATH: str = "./faiss_index.bin"
     FACE_DETECTION_MODEL: str = "retinaface"
+    FACE_DNN_PROTOTXT: str = "./models/deploy.prototxt"
+    FACE_DNN_WEIGHTS: str = "./models/res10_300x300_ssd_iter_140000.caffemodel"
+    FACE_DNN_CONFIDENCE: float = 0.5
     FACE_RECOGNITION_MODEL: str = "facenet"
-    SIMILARITY_THRESHOLD: float = 0.6
+    # Cosine similarity of L2-normalized embeddings
+    COSINE_SIMILARITY_THRESHOLD: float = 0.83
+    # Former 1/(1+L2^2) threshold; its values are far too loose as a cosine
+    SIMILARITY_THRESHOLD: Optional[float] = None
+    FAISS_HNSW_THRESHOLD: int = 1000
+    FAISS_GPU_MIN_TOTAL: int = 50000
     IMAGE_MAX_SIZE: int = 2048
+    BATCH_MAX_IMAGES: int = 32
+    USE_GPU: bool = False
     
     class Config:
         env_file = ".env"
+    
+    @model_validator(mode="after")
+    def reject_legacy_threshold(self):
+        if self.SIMILARITY_THRESHOLD is not None:
+            raise ValueError(
+                "SIMILARITY_THRESHOLD is no longer used; set COSINE_SIMILARITY_THRESHOLD "
+                "(default 0.83) and remove SIMILARITY_THRESHOLD"
+            )
+        return self
 
 settings = Settings()
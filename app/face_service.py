@@ -1,20 +1,53 @@
+import threading
 import numpy as np
 import cv2
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 from app.faiss_index import faiss_index
-from app.utils.image_utils import decode_image, preprocess_image
+from app.utils.image_utils import decode_image, decode_image_bytes, preprocess_image
 from app.utils.liveness import check_liveness
 from app.config import settings
 import face_recognition
+import dlib
+
+# Face crops are letterboxed into a common square so the CNN detector can batch them
+GPU_FACE_SIZE = 256
+
+def _letterbox(image: np.ndarray, size: int) -> Tuple[np.ndarray, float]:
+    """Scale image to fit a size x size square, padding the bottom and right"""
+    height, width = image.shape[:2]
+    scale = size / max(height, width)
+    resized = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))))
+    padded = cv2.copyMakeBorder(
+        resized, 0, size - resized.shape[0], 0, size - resized.shape[1], cv2.BORDER_CONSTANT, value=0
+    )
+    return padded, scale
 
 class FaceService:
     def __init__(self):
-        self.similarity_threshold = settings.SIMILARITY_THRESHOLD
+        self.similarity_threshold = settings.COSINE_SIMILARITY_THRESHOLD
+        self._gpu_enabled = None
+        # dlib models are not safe to run concurrently from pool threads
+        self._model_lock = threading.Lock()
+    
+    def use_gpu(self) -> bool:
+        """Whether dlib models should run on CUDA, checked once on first use"""
+        if self._gpu_enabled is None:
+            self._gpu_enabled = False
+            if settings.USE_GPU:
+                if dlib.DLIB_USE_CUDA and dlib.cuda.get_num_devices() > 0:
+                    self._gpu_enabled = True
+                    print("Running face_recognition models on GPU")
+                else:
+                    print("USE_GPU is set but dlib has no CUDA device available, using CPU")
+        return self._gpu_enabled
+    
+    @staticmethod
+    def score_to_confidence(score: float) -> float:
+        """Clamp a cosine similarity from the index to a [0, 1] confidence"""
+        return min(max(float(score), 0.0), 1.0)
     
     def extract_embedding(self, image_data: str) -> Optional[np.ndarray]:
-        """Extract face embedding from image"""
-        from app.utils.image_utils import detect_face
-        
+        """Extract face embedding from base64 encoded image"""
         print("Starting embedding extraction...")
         
         image = decode_image(image_data)
@@ -24,6 +57,25 @@ class FaceService:
         
         print(f"Image decoded successfully. Shape: {image.shape}")
         
+        return self.extract_embedding_from_array(image)
+    
+    def extract_embedding_from_bytes(self, data: bytes) -> Optional[np.ndarray]:
+        """Extract face embedding from raw uploaded image bytes"""
+        print("Starting embedding extraction...")
+        
+        image = decode_image_bytes(data)
+        if image is None:
+            print("Failed to decode image")
+            return None
+        
+        print(f"Image decoded successfully. Shape: {image.shape}")
+        
+        return self.extract_embedding_from_array(image)
+    
+    def extract_embedding_from_array(self, image: np.ndarray) -> Optional[np.ndarray]:
+        """Extract face embedding from an already decoded BGR image"""
+        from app.utils.image_utils import detect_face
+        
         processed = preprocess_image(image)
         print(f"Image preprocessed. Shape: {processed.shape}")
         
@@ -35,10 +87,39 @@ class FaceService:
         
         print(f"Face detected successfully. Shape: {face.shape}")
         
+        return self._encode_face(face)
+    
+    def extract_embeddings_batch(self, images: List[Optional[np.ndarray]]) -> List[Optional[np.ndarray]]:
+        """Extract face embeddings from several decoded BGR images"""
+        from app.utils.image_utils import detect_face
+        
+        faces = [
+            detect_face(preprocess_image(image)) if image is not None else None
+            for image in images
+        ]
+        print(f"Detected faces in {sum(f is not None for f in faces)}/{len(images)} images")
+        
+        if self.use_gpu():
+            return self._encode_faces_gpu(faces)
+        
+        return [
+            self._encode_face(face) if face is not None and face.size > 0 else None
+            for face in faces
+        ]
+    
+    def _encode_face(self, face: np.ndarray) -> Optional[np.ndarray]:
+        """Run the face_recognition encoder on a cropped face"""
         try:
             # Use face_recognition to extract embedding from the detected face
             face_rgb = cv2.cvtColor(face, cv2.COLOR_BGR2RGB)
-            encodings = face_recognition.face_encodings(face_rgb)
+            use_gpu = self.use_gpu()
+            with self._model_lock:
+                if use_gpu:
+                    # The CNN detector only pays off with CUDA; HOG stays on CPU
+                    locations = face_recognition.face_locations(face_rgb, model="cnn")
+                    encodings = face_recognition.face_encodings(face_rgb, known_face_locations=locations[:1], num_jitters=1)
+                else:
+                    encodings = face_recognition.face_encodings(face_rgb)
             if encodings:
                 embedding = encodings[0].astype('float32')
                 print(f"Embedding created successfully. Shape: {embedding.shape}")
@@ -52,6 +133,42 @@ class FaceService:
             traceback.print_exc()
             return None
     
+    def _encode_faces_gpu(self, faces: List[Optional[np.ndarray]]) -> List[Optional[np.ndarray]]:
+        """Locate faces in all crops with one batched CNN pass, then encode each"""
+        valid = [i for i, face in enumerate(faces) if face is not None and face.size > 0]
+        embeddings = [None] * len(faces)
+        if not valid:
+            return embeddings
+        
+        try:
+            crops = [cv2.cvtColor(faces[i], cv2.COLOR_BGR2RGB) for i in valid]
+            boxed = [_letterbox(crop, GPU_FACE_SIZE) for crop in crops]
+            with self._model_lock:
+                batch_locations = face_recognition.batch_face_locations(
+                    [square for square, _ in boxed], number_of_times_to_upsample=0,
+                    batch_size=settings.BATCH_MAX_IMAGES
+                )
+                for i, crop, (_, scale), locations in zip(valid, crops, boxed, batch_locations):
+                    if not locations:
+                        continue
+                    # Map the box back onto the unscaled crop and encode that,
+                    # so the encoder sees the face at its own aspect ratio
+                    height, width = crop.shape[:2]
+                    top, right, bottom, left = locations[0]
+                    location = (
+                        max(0, round(top / scale)), min(width, round(right / scale)),
+                        min(height, round(bottom / scale)), max(0, round(left / scale)),
+                    )
+                    encodings = face_recognition.face_encodings(crop, known_face_locations=[location], num_jitters=1)
+                    if encodings:
+                        embeddings[i] = encodings[0].astype('float32')
+        except Exception as e:
+            print(f"Error creating embeddings on GPU: {e}")
+            import traceback
+            traceback.print_exc()
+        
+        return embeddings
+    
     def enroll_face(self, user_id: str, image_data: str) -> bool:
         """Enroll a new face"""
         embedding = self.extract_embedding(image_data)
@@ -63,7 +180,12 @@ class FaceService:
     
     def verify_face(self, user_id: str, image_data: str) -> Tuple[bool, float, bool]:
         """Verify if image matches enrolled user"""
-        embedding = self.extract_embedding(image_data)
+        # Decode once and share the array between embedding and liveness
+        image = decode_image(image_data)
+        if image is None:
+            return False, 0.0, False
+        
+        embedding = self.extract_embedding_from_array(image)
         if embedding is None:
             return False, 0.0, False
         
@@ -71,27 +193,44 @@ class FaceService:
         if not results:
             return False, 0.0, False
         
-        matched_user, distance = results[0]
-        confidence = 1.0 / (1.0 + distance)
+        matched_user, score = results[0]
+        confidence = self.score_to_confidence(score)
         verified = matched_user == user_id and confidence >= self.similarity_threshold
         
-        image = decode_image(image_data)
         liveness_passed = check_liveness(image)
         
         return verified, confidence, liveness_passed
     
     def identify_face(self, image_data: str) -> Optional[Tuple[str, float]]:
         """Identify face from database"""
-        embedding = self.extract_embedding(image_data)
+        return self.identify_embedding(self.extract_embedding(image_data))
+    
+    def identify_embedding(self, embedding: Optional[np.ndarray]) -> Optional[Tuple[str, float]]:
+        """Identify an already extracted embedding"""
         if embedding is None:
             return None
         
         results = faiss_index.search(embedding, k=1)
+        return self._best_match(results)
+    
+    def identify_faces_batch(self, images: List[Optional[np.ndarray]]) -> List[Optional[Tuple[str, float]]]:
+        """Identify faces in several decoded images with one batched index search"""
+        embeddings = self.extract_embeddings_batch(images)
+        found = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+        
+        matches = [None] * len(images)
+        if found:
+            results = faiss_index.search_batch(np.stack([embeddings[i] for i in found]), k=1)
+            for i, row_results in zip(found, results):
+                matches[i] = self._best_match(row_results)
+        return matches
+    
+    def _best_match(self, results) -> Optional[Tuple[str, float]]:
         if not results:
             return None
         
-        user_id, distance = results[0]
-        confidence = 1.0 / (1.0 + distance)
+        user_id, score = results[0]
+        confidence = self.score_to_confidence(score)
         
         if confidence >= self.similarity_threshold:
             return user_id, confidence
@@ -2,43 +2,446 @@ import faiss
 import numpy as np
 import pickle
 import os
+import queue
+import struct
+import threading
+import time
+from concurrent.futures import Future
 from app.config import settings
 
+# Embeddings are stored as FP16, halving memory and search bandwidth
+SQ_TYPE = faiss.ScalarQuantizer.QT_fp16
+
+# HNSW graph parameters: neighbours per node and build/search beam widths
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 40
+HNSW_EF_SEARCH = 16
+
+# New embeddings are buffered and added to the index in batches of this size,
+# or once no enrollment has arrived for ADD_FLUSH_INTERVAL seconds
+ADD_BATCH_SIZE = 64
+ADD_FLUSH_INTERVAL = 1.0
+
+# Smallest query batch routed to the GPU copy; single queries stay on CPU
+GPU_MIN_BATCH = 4
+
+# The saved index is mapped read-only so the OS pages in only what searches
+# touch; IO_FLAG_MMAP_IFC maps the flat and SQ codes without copying them
+MMAP_FLAGS = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+
+# User ids are stored as fixed-width UTF-8 bytes, indexed by FAISS id
+USER_ID_MAX_BYTES = 64
+USER_ID_DTYPE = np.dtype(f"S{USER_ID_MAX_BYTES}")
+USER_ID_MIN_CAPACITY = 1024
+
+# Concurrent single searches are gathered for up to SEARCH_BATCH_WAIT
+# seconds and answered together with one batched index call
+SEARCH_BATCH_SIZE = 32
+SEARCH_BATCH_WAIT = 0.001
+
+def encode_user_id(user_id: str) -> bytes:
+    """Encode a user id for the id store, rejecting ids that do not fit"""
+    user_id_bytes = user_id.encode("utf-8")
+    if len(user_id_bytes) > USER_ID_MAX_BYTES:
+        raise ValueError(f"User ID is longer than {USER_ID_MAX_BYTES} bytes")
+    return user_id_bytes
+
+class UserIdStore:
+    """
+    User ids kept in a memory-mapped file of fixed-width records.
+    
+    Lookups by FAISS id read one record and appends write only the new
+    records; the file grows by doubling its capacity.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._ids = None
+        self._count = 0
+        if os.path.exists(path) and os.path.getsize(path) >= USER_ID_DTYPE.itemsize:
+            self._map(os.path.getsize(path) // USER_ID_DTYPE.itemsize)
+    
+    def _map(self, capacity: int):
+        self._ids = np.memmap(self.path, dtype=USER_ID_DTYPE, mode="r+", shape=(capacity,))
+    
+    @property
+    def capacity(self) -> int:
+        return 0 if self._ids is None else len(self._ids)
+    
+    def __len__(self):
+        return self._count
+    
+    def __getitem__(self, idx: int) -> str:
+        return self._ids[idx].decode("utf-8")
+    
+    def __iter__(self):
+        return (self[idx] for idx in range(self._count))
+    
+    def truncate(self, count: int):
+        """Keep only the first count ids, e.g. those covered by the saved index"""
+        if count > self.capacity:
+            raise ValueError(f"{self.path} holds {self.capacity} user ids, {count} requested")
+        self._count = count
+    
+    def extend(self, user_ids):
+        records = [encode_user_id(user_id) for user_id in user_ids]
+        needed = self._count + len(records)
+        if needed > self.capacity:
+            self._grow(needed)
+        self._ids[self._count:needed] = records
+        self._count = needed
+    
+    def _grow(self, needed: int):
+        capacity = max(needed, 2 * self.capacity, USER_ID_MIN_CAPACITY)
+        if self._ids is not None:
+            self._ids.flush()
+            self._ids = None
+        with open(self.path, "ab") as f:
+            f.truncate(capacity * USER_ID_DTYPE.itemsize)
+        self._map(capacity)
+    
+    def flush(self):
+        if self._ids is not None:
+            self._ids.flush()
+
 class FaissIndex:
     def __init__(self, dimension=128):
         self.dimension = dimension
-        self.index = faiss.IndexFlatL2(dimension)
-        self.user_ids = []
+        # Exact search is cheapest for small galleries; switch to HNSW once it grows
+        self.hnsw_threshold = settings.FAISS_HNSW_THRESHOLD
+        # Embeddings are L2-normalized, so inner product is cosine similarity
+        self.index = self._build_flat_index()
+        # When the saved index is mapped, self.index shards it with an
+        # in-memory delta index that takes new embeddings until compaction
+        self._base = None
+        self._delta = None
         self.index_path = settings.FAISS_INDEX_PATH
+        self.user_ids = UserIdStore(f"{self.index_path}.ids")
+        # Ids past the saved index belong to unsaved adds; the journal restores them
+        self.user_ids.truncate(0)
+        self.journal_path = f"{self.index_path}.journal"
+        
+        self._lock = threading.Lock()
+        self._pending = np.empty((ADD_BATCH_SIZE, dimension), dtype=np.float32)
+        self._pending_adds = []
+        self._dirty = False
+        self._flush_timer = None
+        
+        self._search_queue = queue.Queue()
+        self._search_thread = None
+        self._search_thread_lock = threading.Lock()
+        
+        # Exact GPU copy of the index, built once the gallery is large enough
+        self.gpu_min_total = settings.FAISS_GPU_MIN_TOTAL
+        self.gpu_index = None
+        self._gpu_resources = None
+        
         self.load_index()
+        self._replay_journal()
+        self._maybe_upgrade()
+        # A mapped index keeps replayed embeddings in the delta until
+        # shutdown, so startup does not load the whole file
+        if self._dirty and self._base is None:
+            self.compact()
+        self._maybe_enable_gpu()
+    
+    def _build_flat_index(self):
+        return faiss.IndexScalarQuantizer(self.dimension, SQ_TYPE, faiss.METRIC_INNER_PRODUCT)
+    
+    def _build_hnsw_index(self):
+        index = faiss.IndexHNSWSQ(self.dimension, SQ_TYPE, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+    
+    def _attach_mapped(self, base):
+        """Search the mapped index together with a fresh delta index"""
+        if isinstance(base, faiss.IndexHNSW):
+            base.hnsw.efSearch = HNSW_EF_SEARCH
+        self._base = base
+        self._delta = self._build_flat_index()
+        self.index = faiss.IndexShards(self.dimension, False, True)
+        self.index.add_shard(self._base)
+        self.index.add_shard(self._delta)
+    
+    def _add_vectors(self, vectors: np.ndarray):
+        if self._base is None:
+            self.index.add(vectors)
+        else:
+            self._delta.add(vectors)
+            self.index.syncWithSubIndexes()
+    
+    def _reconstruct_all(self) -> np.ndarray:
+        if self._base is None:
+            return self.index.reconstruct_n(0, self.index.ntotal)
+        return np.vstack([
+            self._base.reconstruct_n(0, self._base.ntotal),
+            self._delta.reconstruct_n(0, self._delta.ntotal),
+        ])
+    
+    def _maybe_upgrade(self) -> bool:
+        """Rebuild the flat index as HNSW once it crosses the size threshold"""
+        if isinstance(self._base if self._base is not None else self.index, faiss.IndexHNSW):
+            return False
+        if self.index.ntotal < self.hnsw_threshold:
+            return False
+        
+        vectors = self._reconstruct_all()
+        index = self._build_hnsw_index()
+        index.add(vectors)
+        self.index = index
+        self._base = None
+        self._delta = None
+        self._dirty = True
+        print(f"Upgraded FAISS index to HNSW ({index.ntotal} embeddings)")
+        return True
+    
+    def _normalize(self, embedding: np.ndarray) -> np.ndarray:
+        # faiss.normalize_L2 works in place, so normalize a private copy
+        vectors = np.array(embedding, dtype=np.float32).reshape(-1, self.dimension)
+        faiss.normalize_L2(vectors)
+        return vectors
+    
+    def _maybe_enable_gpu(self) -> bool:
+        """Mirror the index on the GPU once brute-force CPU search gets expensive"""
+        if self.gpu_index is not None or self.index.ntotal <= self.gpu_min_total:
+            return False
+        if faiss.get_num_gpus() == 0:
+            return False
+        
+        # HNSW and SQ indexes cannot be cloned to the GPU, so mirror the
+        # vectors into an exact inner-product index stored as FP16
+        cpu_index = faiss.IndexFlatIP(self.dimension)
+        cpu_index.add(self._reconstruct_all())
+        options = faiss.GpuClonerOptions()
+        options.useFloat16 = True
+        self._gpu_resources = faiss.StandardGpuResources()
+        self.gpu_index = faiss.index_cpu_to_gpu(self._gpu_resources, 0, cpu_index, options)
+        print(f"Mirrored FAISS index on GPU ({self.gpu_index.ntotal} embeddings)")
+        return True
     
     def add_embedding(self, user_id: str, embedding: np.ndarray):
-        self.index.add(embedding.reshape(1, -1))
-        self.user_ids.append(user_id)
-        self.save_index()
+        """Queue an embedding for batched insertion and journal it to disk"""
+        encode_user_id(user_id)
+        embedding = self._normalize(embedding)[0]
+        with self._lock:
+            self._append_journal(user_id, embedding)
+            self._pending[len(self._pending_adds)] = embedding
+            self._pending_adds.append(user_id)
+            
+            if len(self._pending_adds) >= ADD_BATCH_SIZE:
+                self._flush_pending()
+            else:
+                self._schedule_flush()
+    
+    def flush(self):
+        """Add all buffered embeddings to the index"""
+        with self._lock:
+            self._flush_pending()
+    
+    def _schedule_flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+        self._flush_timer = threading.Timer(ADD_FLUSH_INTERVAL, self.flush)
+        self._flush_timer.daemon = True
+        self._flush_timer.start()
+    
+    def _flush_pending(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        
+        count = len(self._pending_adds)
+        if count == 0:
+            return
+        
+        self._add_vectors(self._pending[:count])
+        if self.gpu_index is not None:
+            self.gpu_index.add(self._pending[:count])
+        self.user_ids.extend(self._pending_adds)
+        self._pending_adds = []
+        self._dirty = True
+        self._maybe_upgrade()
+        self._maybe_enable_gpu()
     
     def search(self, embedding: np.ndarray, k=1):
-        # Return empty if index is empty
-        if self.index.ntotal == 0:
-            return []
-        
-        distances, indices = self.index.search(embedding.reshape(1, -1), k)
-        results = []
-        for dist, idx in zip(distances[0], indices[0]):
-            # Check if index is valid (not -1 which means no result)
-            if idx >= 0 and idx < len(self.user_ids):
-                results.append((self.user_ids[idx], float(dist)))
+        """Return up to k (user_id, cosine similarity) pairs, best match first"""
+        future = Future()
+        self._search_queue.put((embedding, k, future))
+        self._ensure_search_thread()
+        return future.result()
+    
+    def _ensure_search_thread(self):
+        if self._search_thread is not None:
+            return
+        with self._search_thread_lock:
+            if self._search_thread is None:
+                thread = threading.Thread(target=self._run_search_batcher, name="faiss-search", daemon=True)
+                thread.start()
+                self._search_thread = thread
+    
+    def _run_search_batcher(self):
+        """Answer queued searches in batches of up to SEARCH_BATCH_SIZE"""
+        while True:
+            requests = [self._search_queue.get()]
+            deadline = time.monotonic() + SEARCH_BATCH_WAIT
+            while len(requests) < SEARCH_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self._search_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            
+            try:
+                embeddings = np.vstack([embedding for embedding, _, _ in requests])
+                results = self.search_batch(embeddings, max(k for _, k, _ in requests))
+            except Exception as e:
+                for _, _, future in requests:
+                    future.set_exception(e)
+                continue
+            
+            for (_, k, future), row_results in zip(requests, results):
+                future.set_result(row_results[:k])
+    
+    def search_batch(self, embeddings: np.ndarray, k=1):
+        """Search several embeddings with one index call, one result list per row"""
+        queries = self._normalize(embeddings)
+        results = [[] for _ in range(len(queries))]
+        
+        with self._lock:
+            index = self.index
+            if self.gpu_index is not None and len(queries) >= GPU_MIN_BATCH:
+                index = self.gpu_index
+            
+            if index.ntotal > 0:
+                scores, indices = index.search(queries, k)
+                for row, (row_scores, row_indices) in enumerate(zip(scores, indices)):
+                    for score, idx in zip(row_scores, row_indices):
+                        # Check if index is valid (not -1 which means no result)
+                        if idx >= 0 and idx < len(self.user_ids):
+                            results[row].append((self.user_ids[idx], float(score)))
+            
+            # Embeddings still waiting for the next batch are scanned directly
+            count = len(self._pending_adds)
+            if count > 0:
+                pending_scores = queries @ self._pending[:count].T
+                for row, row_scores in enumerate(pending_scores):
+                    for idx in np.argsort(-row_scores)[:k]:
+                        results[row].append((self._pending_adds[idx], float(row_scores[idx])))
+        
+        for row_results in results:
+            row_results.sort(key=lambda r: r[1], reverse=True)
+            del row_results[k:]
         return results
     
+    def _append_journal(self, user_id: str, embedding: np.ndarray):
+        # Record layout: uint32 id length, utf-8 user id, float32 embedding
+        user_id_bytes = user_id.encode("utf-8")
+        with open(self.journal_path, "ab") as f:
+            f.write(struct.pack("<I", len(user_id_bytes)))
+            f.write(user_id_bytes)
+            f.write(embedding.astype("<f4").tobytes())
+    
+    def _replay_journal(self):
+        """Apply enrollments journaled since the last compaction"""
+        if not os.path.exists(self.journal_path):
+            return
+        
+        with open(self.journal_path, "rb") as f:
+            data = f.read()
+        
+        known = set(self.user_ids)
+        user_ids = []
+        embeddings = []
+        record_size = self.dimension * 4
+        offset = 0
+        while offset + 4 <= len(data):
+            (length,) = struct.unpack_from("<I", data, offset)
+            end = offset + 4 + length + record_size
+            if end > len(data):
+                # Truncated tail from an interrupted write
+                break
+            user_id = data[offset + 4:offset + 4 + length].decode("utf-8")
+            # Skip records already compacted into the index file
+            if user_id not in known:
+                known.add(user_id)
+                user_ids.append(user_id)
+                embeddings.append(np.frombuffer(data, dtype="<f4", count=self.dimension, offset=offset + 4 + length))
+            offset = end
+        
+        if embeddings:
+            self._add_vectors(self._normalize(np.vstack(embeddings)))
+            self.user_ids.extend(user_ids)
+        self._dirty = True
+    
+    def compact(self):
+        """Rewrite the full index file and truncate the journal"""
+        with self._lock:
+            self._flush_pending()
+            if self._dirty:
+                self.save_index()
+                if os.path.exists(self.journal_path):
+                    os.remove(self.journal_path)
+                self._dirty = False
+                self._attach_mapped(faiss.read_index(self.index_path, MMAP_FLAGS))
+    
     def save_index(self):
-        faiss.write_index(self.index, self.index_path)
-        with open(f"{self.index_path}.meta", "wb") as f:
-            pickle.dump(self.user_ids, f)
+        index = self.index
+        if self._base is not None:
+            # The mapped file is read-only, so merge the delta into a loaded copy
+            index = faiss.read_index(self.index_path)
+            if self._delta.ntotal > 0:
+                index.add(self._delta.reconstruct_n(0, self._delta.ntotal))
+        
+        # Ids are written through the mapping; make them durable before the
+        # index that refers to them, and replace the index file atomically
+        self.user_ids.flush()
+        faiss.write_index(index, f"{self.index_path}.tmp")
+        os.replace(f"{self.index_path}.tmp", self.index_path)
+        
+        legacy_meta = f"{self.index_path}.meta"
+        if os.path.exists(legacy_meta):
+            os.remove(legacy_meta)
+    
+    @staticmethod
+    def _is_current_layout(index) -> bool:
+        if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+            return False
+        return isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexHNSWSQ))
     
     def load_index(self):
         if os.path.exists(self.index_path):
-            self.index = faiss.read_index(self.index_path)
-            with open(f"{self.index_path}.meta", "rb") as f:
-                self.user_ids = pickle.load(f)
+            index = faiss.read_index(self.index_path, MMAP_FLAGS)
+            legacy_meta = f"{self.index_path}.meta"
+            if os.path.exists(legacy_meta):
+                # Older installs pickled the id list next to the index
+                with open(legacy_meta, "rb") as f:
+                    self.user_ids.extend(pickle.load(f))
+                self.user_ids.flush()
+                # The next compaction removes the pickle
+                self._dirty = True
+                available = len(self.user_ids)
+            else:
+                available = self.user_ids.capacity
+            if available < index.ntotal:
+                # Searching would credit matches to the wrong users
+                raise RuntimeError(
+                    f"Found {available} user ids for the {index.ntotal} embeddings "
+                    f"in {self.index_path}; the id file is missing or truncated"
+                )
+            self.user_ids.truncate(index.ntotal)
+            
+            if not self._is_current_layout(index):
+                # Older index files hold raw L2 or float32 embeddings;
+                # normalize them into a fresh FP16 inner-product index
+                print(f"Migrating FAISS index to FP16 inner product ({index.ntotal} embeddings)")
+                if index.ntotal > 0:
+                    self.index.add(self._normalize(index.reconstruct_n(0, index.ntotal)))
+                self._dirty = True
+                return
+            
+            self._attach_mapped(index)
 
 faiss_index = FaissIndex()
@@ -3,6 +3,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from app.routers import recognition
 from app.database import init_db
+from app.faiss_index import faiss_index
 import os
 
 
@@ -28,6 +29,11 @@ app.include_router(recognition.router)
 async def startup_event():
     init_db()
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Fold the enrollment journal back into the index file
+    faiss_index.compact()
+
 @app.get("/")
 async def root():
     return {"message": "Facial Recognition Service API"}
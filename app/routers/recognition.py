@@ -1,17 +1,26 @@
 from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
+from typing import List
 from app.schemas import (
     FaceEnrollRequest, FaceVerifyRequest, FaceIdentifyRequest,
-    EnrollResponse, VerifyResponse, FaceResponse
+    EnrollResponse, VerifyResponse, FaceResponse, FaceBatchResponse
 )
+from app.config import settings
 from app.face_service import face_service
-from app.faiss_index import faiss_index
+from app.faiss_index import faiss_index, encode_user_id
 from app.database import get_db
 from app.models import FaceRecord
-import base64
 
 router = APIRouter(prefix="/recognition", tags=["recognition"])
 
+def check_user_id(user_id: str):
+    """Reject user IDs too long for the index's fixed-width id store"""
+    try:
+        encode_user_id(user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.post("/enroll", response_model=EnrollResponse)
 async def enroll_face(
     user_id: str = Form(...),
@@ -23,6 +32,8 @@ async def enroll_face(
     
     SECURITY: Prevents the same face from being enrolled with multiple user IDs.
     """
+    check_user_id(user_id)
+    
     # Check if user ID already exists
     existing = db.query(FaceRecord).filter(FaceRecord.user_id == user_id).first()
     if existing:
@@ -31,12 +42,11 @@ async def enroll_face(
             detail=f"User ID '{user_id}' is already enrolled"
         )
     
-    # Read file and convert to base64
+    # Read the uploaded file and decode its bytes directly
     contents = await file.read()
-    base64_string = base64.b64encode(contents).decode('utf-8')
     
     # Extract face embedding
-    embedding = face_service.extract_embedding(base64_string)
+    embedding = await run_in_threadpool(face_service.extract_embedding_from_bytes, contents)
     if embedding is None:
         raise HTTPException(
             status_code=400,
@@ -44,11 +54,11 @@ async def enroll_face(
         )
     
     # CRITICAL: Check if this face already exists in the system
-    results = faiss_index.search(embedding, k=1)
+    results = await run_in_threadpool(faiss_index.search, embedding, k=1)
     
     if results and len(results) > 0:
-        matched_user_id, distance = results[0]
-        confidence = 1.0 / (1.0 + distance)
+        matched_user_id, score = results[0]
+        confidence = face_service.score_to_confidence(score)
         
         # If confidence is high, this face already exists
         if confidence >= face_service.similarity_threshold:
@@ -57,13 +67,8 @@ async def enroll_face(
                 detail=f"FRAUD ALERT: This face is already registered to user '{matched_user_id}'. Cannot enroll the same face with multiple user IDs."
             )
     
-    # Face is unique - proceed with enrollment
-    success = face_service.enroll_face(user_id, base64_string)
-    if not success:
-        raise HTTPException(
-            status_code=500,
-            detail="Failed to enroll face. Please try again."
-        )
+    # Face is unique - proceed with enrollment using the extracted embedding
+    await run_in_threadpool(faiss_index.add_embedding, user_id, embedding)
     
     face_record = FaceRecord(user_id=user_id)
     db.add(face_record)
@@ -88,15 +93,17 @@ async def verify_face(
     SECURITY: Checks if the face already exists in the system to prevent
     the same person from enrolling with multiple user IDs.
     """
-    # Read file and convert to base64
+    check_user_id(user_id)
+    
+    # Read the uploaded file and decode its bytes directly
     contents = await file.read()
-    base64_string = base64.b64encode(contents).decode('utf-8')
     
-    # Extract face embedding from the uploaded image
-    from app.utils.image_utils import decode_image
+    # Decode once and reuse the array for embedding extraction and liveness
+    from app.utils.image_utils import decode_image_bytes
     from app.utils.liveness import check_liveness
     
-    embedding = face_service.extract_embedding(base64_string)
+    image = await run_in_threadpool(decode_image_bytes, contents)
+    embedding = await run_in_threadpool(face_service.extract_embedding_from_array, image) if image is not None else None
     if embedding is None:
         raise HTTPException(
             status_code=400,
@@ -104,16 +111,15 @@ async def verify_face(
         )
     
     # Check liveness
-    image = decode_image(base64_string)
-    liveness_passed = check_liveness(image) if image is not None else False
+    liveness_passed = await run_in_threadpool(check_liveness, image)
     
     # CRITICAL: Search if this face already exists in the system
-    results = faiss_index.search(embedding, k=1)
+    results = await run_in_threadpool(faiss_index.search, embedding, k=1)
     
     if results and len(results) > 0:
         # Face found in database
-        matched_user_id, distance = results[0]
-        confidence = 1.0 / (1.0 + distance)
+        matched_user_id, score = results[0]
+        confidence = face_service.score_to_confidence(score)
         
         # Check if confidence is high enough to consider it a match
         if confidence >= face_service.similarity_threshold:
@@ -145,13 +151,8 @@ async def verify_face(
             detail=f"User ID '{user_id}' already exists with a different face. Cannot replace existing user's face."
         )
     
-    # New face, new user - ENROLL
-    success = face_service.enroll_face(user_id, base64_string)
-    if not success:
-        raise HTTPException(
-            status_code=500,
-            detail="Failed to enroll face. Please try again."
-        )
+    # New face, new user - ENROLL using the extracted embedding
+    await run_in_threadpool(faiss_index.add_embedding, user_id, embedding)
     
     face_record = FaceRecord(user_id=user_id)
     db.add(face_record)
@@ -169,12 +170,14 @@ async def verify_face(
 @router.post("/verify-base64", response_model=VerifyResponse)
 async def verify_face_base64(request: FaceVerifyRequest, db: Session = Depends(get_db)):
     """Verify face using base64 encoded image. Auto-enrolls if not found."""
+    check_user_id(request.user_id)
+    
     # First check if user exists in database
     existing = db.query(FaceRecord).filter(FaceRecord.user_id == request.user_id).first()
     
     if not existing:
         # User doesn't exist - auto-enroll
-        success = face_service.enroll_face(request.user_id, request.image)
+        success = await run_in_threadpool(face_service.enroll_face, request.user_id, request.image)
         if not success:
             raise HTTPException(
                 status_code=400, 
@@ -188,8 +191,8 @@ async def verify_face_base64(request: FaceVerifyRequest, db: Session = Depends(g
         # Check liveness for the enrolled face
         from app.utils.image_utils import decode_image
         from app.utils.liveness import check_liveness
-        image = decode_image(request.image)
-        liveness_passed = check_liveness(image) if image is not None else False
+        image = await run_in_threadpool(decode_image, request.image)
+        liveness_passed = await run_in_threadpool(check_liveness, image) if image is not None else False
         
         return VerifyResponse(
             verified=True,
@@ -201,8 +204,8 @@ async def verify_face_base64(request: FaceVerifyRequest, db: Session = Depends(g
         )
     
     # User exists - verify face
-    verified, confidence, liveness_passed = face_service.verify_face(
-        request.user_id, request.image
+    verified, confidence, liveness_passed = await run_in_threadpool(
+        face_service.verify_face, request.user_id, request.image
     )
     
     if not verified:
@@ -223,11 +226,11 @@ async def verify_face_base64(request: FaceVerifyRequest, db: Session = Depends(g
 @router.post("/identify", response_model=FaceResponse)
 async def identify_face(file: UploadFile = File(...)):
     """Identify a face from the database by uploading an image file"""
-    # Read file and convert to base64
+    # Read the uploaded file and decode its bytes directly
     contents = await file.read()
-    base64_string = base64.b64encode(contents).decode('utf-8')
     
-    result = face_service.identify_face(base64_string)
+    embedding = await run_in_threadpool(face_service.extract_embedding_from_bytes, contents)
+    result = await run_in_threadpool(face_service.identify_embedding, embedding)
     if result is None:
         raise HTTPException(status_code=404, detail="No matching face found")
     
@@ -237,11 +240,38 @@ async def identify_face(file: UploadFile = File(...)):
 @router.post("/identify-base64", response_model=FaceResponse)
 async def identify_face_base64(request: FaceIdentifyRequest):
     """Identify a face from the database using base64 encoded image"""
-    result = face_service.identify_face(request.image)
+    result = await run_in_threadpool(face_service.identify_face, request.image)
     if result is None:
         raise HTTPException(status_code=404, detail="No matching face found")
     
     user_id, confidence = result
     return FaceResponse(user_id=user_id, confidence=confidence)
 
- 
\ No newline at end of file
+ 
+
+@router.post("/identify-batch", response_model=FaceBatchResponse)
+async def identify_face_batch(files: List[UploadFile] = File(...)):
+    """
+    Identify faces in several uploaded images at once.
+    
+    All embeddings are matched with a single batched index search. Results
+    are returned in upload order, with null for images without a match.
+    """
+    if len(files) > settings.BATCH_MAX_IMAGES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many images. At most {settings.BATCH_MAX_IMAGES} can be identified per request."
+        )
+    
+    from app.utils.image_utils import decode_image_bytes
+    
+    images = []
+    for file in files:
+        contents = await file.read()
+        images.append(await run_in_threadpool(decode_image_bytes, contents))
+    
+    matches = await run_in_threadpool(face_service.identify_faces_batch, images)
+    return FaceBatchResponse(results=[
+        FaceResponse(user_id=match[0], confidence=match[1]) if match is not None else None
+        for match in matches
+    ])
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 class FaceEnrollRequest(BaseModel):
@@ -18,6 +18,9 @@ class FaceResponse(BaseModel):
     confidence: float
     liveness_score: Optional[float] = None
 
+class FaceBatchResponse(BaseModel):
+    results: List[Optional[FaceResponse]]  # None where no match was found
+
 class EnrollResponse(BaseModel):
     user_id: str
     message: str
@@ -1,13 +1,52 @@
 import base64
+import os
+import threading
 import numpy as np
 import cv2
-from typing import Optional
+from typing import List, Optional, Tuple
 from app.config import settings
+from app.utils.scratch import get_scratch_pool
+
+# Input size and BGR channel means of the ResNet-10 SSD face detector
+DNN_INPUT_SIZE = (300, 300)
+DNN_MEAN = (104.0, 177.0, 123.0)
+
+def load_face_net():
+    """Load the OpenCV DNN face detector, or None if its model files are missing"""
+    prototxt = settings.FACE_DNN_PROTOTXT
+    weights = settings.FACE_DNN_WEIGHTS
+    if not (os.path.exists(prototxt) and os.path.exists(weights)):
+        print("DNN face detector model not found, falling back to Haar cascade")
+        return None
+    
+    net = cv2.dnn.readNetFromCaffe(prototxt, weights)
+    net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+    net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+    return net
+
+# Detectors are loaded once at import instead of per request
+_FACE_NET = load_face_net()
+
+_FACE_CASCADE = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+if _FACE_CASCADE.empty():
+    raise RuntimeError("Failed to load Haar Cascade classifier")
+
+# The shared detectors keep per-call state, so requests running in the
+# thread pool take turns on them
+_DETECTOR_LOCK = threading.Lock()
 
 def decode_image(image_data: str) -> Optional[np.ndarray]:
     """Decode base64 image to numpy array"""
     try:
         image_bytes = base64.b64decode(image_data)
+    except Exception as e:
+        print(f"Error decoding image: {e}")
+        return None
+    return decode_image_bytes(image_bytes)
+
+def decode_image_bytes(image_bytes: bytes) -> Optional[np.ndarray]:
+    """Decode raw image file bytes (JPEG, PNG, ...) to numpy array"""
+    try:
         nparr = np.frombuffer(image_bytes, np.uint8)
         image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
         return image
@@ -20,28 +59,110 @@ def encode_image(image: np.ndarray) -> str:
     _, buffer = cv2.imencode('.jpg', image)
     return base64.b64encode(buffer).decode('utf-8')
 
-def preprocess_image(image: np.ndarray) -> np.ndarray:
-    """Preprocess image for face recognition"""
-    # Resize if too large
-    height, width = image.shape[:2]
+def preprocessed_size(height: int, width: int) -> Tuple[int, int]:
+    """(width, height) that preprocess_image produces for an image of this size"""
     max_size = settings.IMAGE_MAX_SIZE
-    
     if max(height, width) > max_size:
         scale = max_size / max(height, width)
-        new_width = int(width * scale)
-        new_height = int(height * scale)
-        image = cv2.resize(image, (new_width, new_height))
+        return int(width * scale), int(height * scale)
+    return width, height
+
+def preprocess_image(
+    image: np.ndarray, resize_dst: Optional[np.ndarray] = None, dst: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Preprocess image for face recognition.
+    
+    resize_dst and dst optionally receive the resized and the RGB image.
+    Both have the preprocessed_size of the input; resize_dst has the
+    input's channels and dst has three.
+    """
+    # Resize if too large
+    height, width = image.shape[:2]
+    size = preprocessed_size(height, width)
+    if size != (width, height):
+        image = cv2.resize(image, size, dst=resize_dst)
     
     # Convert to RGB
     if len(image.shape) == 2:
-        image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB, dst=dst)
     elif image.shape[2] == 4:
-        image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGB)
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGB, dst=dst)
     else:
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=dst)
     
     return image
 
+def detect_faces_dnn(image: np.ndarray) -> List[Tuple[int, int, int, int]]:
+    """Run a single SSD forward pass and return (x, y, w, h) face boxes"""
+    if len(image.shape) == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    
+    height, width = image.shape[:2]
+    # Images reaching the detector are RGB; swapRB feeds the network BGR
+    blob = cv2.dnn.blobFromImage(image, 1.0, DNN_INPUT_SIZE, DNN_MEAN, swapRB=True)
+    with _DETECTOR_LOCK:
+        _FACE_NET.setInput(blob)
+        detections = _FACE_NET.forward()
+    
+    faces = []
+    for detection in detections[0, 0]:
+        if detection[2] < settings.FACE_DNN_CONFIDENCE:
+            continue
+        x_start = max(0, int(detection[3] * width))
+        y_start = max(0, int(detection[4] * height))
+        x_end = min(width, int(detection[5] * width))
+        y_end = min(height, int(detection[6] * height))
+        if x_end > x_start and y_end > y_start:
+            faces.append((x_start, y_start, x_end - x_start, y_end - y_start))
+    return faces
+
+def detect_faces_cascade(image: np.ndarray):
+    """Haar cascade fallback used when the DNN model is not available"""
+    # Convert to grayscale for face detection
+    if len(image.shape) == 3:
+        gray_buffer = get_scratch_pool().get("detect_gray", image.shape[:2], np.uint8)
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY, dst=gray_buffer)
+    else:
+        gray = image
+    
+    # Try multiple detection passes with different parameters
+    with _DETECTOR_LOCK:
+        return _detect_faces_cascade_locked(gray)
+
+def _detect_faces_cascade_locked(gray: np.ndarray):
+    # First attempt: Standard parameters
+    faces = _FACE_CASCADE.detectMultiScale(
+        gray,
+        scaleFactor=1.1,
+        minNeighbors=5,
+        minSize=(30, 30),
+        flags=cv2.CASCADE_SCALE_IMAGE
+    )
+    
+    # Second attempt: More lenient parameters
+    if len(faces) == 0:
+        print("First detection failed, trying with relaxed parameters...")
+        faces = _FACE_CASCADE.detectMultiScale(
+            gray,
+            scaleFactor=1.05,
+            minNeighbors=3,
+            minSize=(20, 20),
+            flags=cv2.CASCADE_SCALE_IMAGE
+        )
+    
+    # Third attempt: Even more lenient
+    if len(faces) == 0:
+        print("Second detection failed, trying with very relaxed parameters...")
+        faces = _FACE_CASCADE.detectMultiScale(
+            gray,
+            scaleFactor=1.2,
+            minNeighbors=3,
+            minSize=(20, 20)
+        )
+    
+    return faces
+
 def detect_face(image: np.ndarray) -> Optional[np.ndarray]:
     """Detect face in image and return cropped face"""
     try:
@@ -50,51 +171,10 @@ def detect_face(image: np.ndarray) -> Optional[np.ndarray]:
             print("Invalid image provided")
             return None
         
-        # Convert to grayscale for face detection
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        if _FACE_NET is not None:
+            faces = detect_faces_dnn(image)
         else:
-            gray = image
-        
-        # Load Haar Cascade classifier for face detection
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        
-        if face_cascade.empty():
-            print("Failed to load Haar Cascade classifier")
-            return None
-        
-        # Try multiple detection passes with different parameters
-        faces = None
-        
-        # First attempt: Standard parameters
-        faces = face_cascade.detectMultiScale(
-            gray,
-            scaleFactor=1.1,
-            minNeighbors=5,
-            minSize=(30, 30),
-            flags=cv2.CASCADE_SCALE_IMAGE
-        )
-        
-        # Second attempt: More lenient parameters
-        if len(faces) == 0:
-            print("First detection failed, trying with relaxed parameters...")
-            faces = face_cascade.detectMultiScale(
-                gray,
-                scaleFactor=1.05,
-                minNeighbors=3,
-                minSize=(20, 20),
-                flags=cv2.CASCADE_SCALE_IMAGE
-            )
-        
-        # Third attempt: Even more lenient
-        if len(faces) == 0:
-            print("Second detection failed, trying with very relaxed parameters...")
-            faces = face_cascade.detectMultiScale(
-                gray,
-                scaleFactor=1.2,
-                minNeighbors=3,
-                minSize=(20, 20)
-            )
+            faces = detect_faces_cascade(image)
         
         # If still no face detected, return None (DO NOT use fallback)
         if len(faces) == 0:
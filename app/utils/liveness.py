@@ -1,6 +1,48 @@
 import numpy as np
 import cv2
+from numba import njit
 from typing import Optional, Tuple
+from app.utils.scratch import get_scratch_pool
+
+
+# nogil lets the three concurrent liveness checks run this in parallel
+@njit(cache=True, fastmath=True, nogil=True)
+def _high_frequency_ratio(spectrum: np.ndarray, radius: int, width: int) -> float:
+    """
+    Share of spectral energy outside a centred disk of the given radius,
+    computed in one pass instead of building shifted, magnitude and mask
+    images.
+    
+    spectrum is the unshifted rfft2 half spectrum of a real image of the
+    given width. Columns other than DC and Nyquist stand for two
+    conjugate-symmetric bins and are counted twice, so the ratio equals
+    the one over the full spectrum.
+    """
+    rows, cols = spectrum.shape
+    radius_sq = radius * radius
+    total = 0.0
+    low = 0.0
+    for y in range(rows):
+        # Signed row frequency, i.e. the offset from centre after fftshift
+        dy = y if y <= rows // 2 else y - rows
+        for x in range(cols):
+            weight = 2.0
+            if x == 0 or (x == cols - 1 and width % 2 == 0):
+                weight = 1.0
+            value = weight * abs(spectrum[y, x])
+            total += value
+            if dy * dy + x * x <= radius_sq:
+                low += value
+    return (total - low) / (total + 1e-10)
+
+
+# Frames up to a typical capture size are analyzed as they are; larger ones
+# are downsampled so their longer side is this long, keeping the aspect ratio
+ANALYSIS_MAX_SIDE = 640
+
+# Compile the kernel at import so the first request does not pay for it
+_high_frequency_ratio(np.zeros((4, 3), dtype=np.complex128), 1, 4)
+
 
 def check_liveness(image: np.ndarray, threshold: float = 0.5) -> bool:
     """
@@ -30,22 +72,45 @@ def calculate_liveness_score(image: np.ndarray) -> float:
     Returns:
         Score between 0 (likely spoof) and 1 (likely live)
     """
+    # Intermediates live in per-thread scratch buffers reused across calls
+    pool = get_scratch_pool()
+    
+    height, width = image.shape[:2]
+    scale = 1.0
+    if max(height, width) > ANALYSIS_MAX_SIDE:
+        scale = ANALYSIS_MAX_SIDE / max(height, width)
+        small_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        small = pool.get("liveness_small", (small_size[1], small_size[0]) + image.shape[2:], image.dtype)
+        image = cv2.resize(image, small_size, dst=small, interpolation=cv2.INTER_AREA)
+    
+    # Shared intermediates: each conversion, filter and transform runs once
+    # per image and is handed to every analyzer that needs it
+    size = image.shape[:2]
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=pool.get("liveness_gray", size, np.uint8))
+    # Float32 halves the bandwidth of the filter; the variances below are
+    # still accumulated in float64
+    laplacian = cv2.Laplacian(gray, cv2.CV_32F, dst=pool.get("liveness_laplacian", size, np.float32))
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=pool.get("liveness_hsv", size + (3,), np.uint8))
+    # Real input: rfft2 keeps only the non-redundant half of the spectrum
+    spectrum_shape = (size[0], size[1] // 2 + 1)
+    spectrum = np.fft.rfft2(gray, out=pool.get("liveness_spectrum", spectrum_shape, np.complex128))
+    
     scores = []
     
     # 1. Texture analysis - real faces have more texture variation
-    texture_score = analyze_texture(image)
+    texture_score = analyze_texture(laplacian, scale)
     scores.append(texture_score)
     
     # 2. Color diversity - printed photos have less color variation
-    color_score = analyze_color_diversity(image)
+    color_score = analyze_color_diversity(hsv)
     scores.append(color_score)
     
     # 3. Frequency analysis - screens/prints have different frequency patterns
-    frequency_score = analyze_frequency(image)
+    frequency_score = analyze_frequency(spectrum, gray.shape[1])
     scores.append(frequency_score)
     
     # 4. Sharpness check - blurry images might be from screens
-    sharpness_score = analyze_sharpness(image)
+    sharpness_score = analyze_sharpness(laplacian, scale)
     scores.append(sharpness_score)
     
     # Weighted average of all scores
@@ -55,22 +120,23 @@ def calculate_liveness_score(image: np.ndarray) -> float:
     return overall_score
 
 
-def analyze_texture(image: np.ndarray) -> float:
+def analyze_texture(laplacian: np.ndarray, scale: float = 1.0) -> float:
     """
     Analyze texture patterns using Local Binary Patterns (LBP).
     Real faces have richer texture than printed photos.
-    """
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     
+    Args:
+        laplacian: Laplacian of the grayscale image
+        scale: Factor the image was downsampled by before analysis
+    """
     # Calculate LBP-like texture measure
     # Compare each pixel with its neighbors
-    rows, cols = gray.shape
+    rows, cols = laplacian.shape
     if rows < 3 or cols < 3:
         return 0.5
     
     # Simple texture variance calculation
-    laplacian = cv2.Laplacian(gray, cv2.CV_64F)
-    texture_variance = np.var(laplacian)
+    texture_variance = np.var(laplacian, dtype=np.float64) * scale
     
     # Normalize score (higher variance = more texture = more likely live)
     # Typical range: 100-10000 for live faces, 10-100 for prints
@@ -79,25 +145,21 @@ def analyze_texture(image: np.ndarray) -> float:
     return score
 
 
-def analyze_color_diversity(image: np.ndarray) -> float:
+def analyze_color_diversity(hsv: np.ndarray) -> float:
     """
     Analyze color distribution. Live faces have more color variation
     than printed photos or screens.
-    """
-    # Convert to HSV for better color analysis
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
     
+    Args:
+        hsv: Image converted to HSV (OpenCV ranges)
+    """
     # Calculate color histogram diversity
-    h_hist = cv2.calcHist([hsv], [0], None, [180], [0, 180])
-    s_hist = cv2.calcHist([hsv], [1], None, [256], [0, 256])
-    
-    # Normalize histograms
-    h_hist = h_hist.flatten() / h_hist.sum()
-    s_hist = s_hist.flatten() / s_hist.sum()
+    h_counts = np.bincount(hsv[..., 0].ravel(), minlength=180)
+    s_counts = np.bincount(hsv[..., 1].ravel(), minlength=256)
     
     # Calculate entropy (higher entropy = more diversity)
-    h_entropy = -np.sum(h_hist * np.log2(h_hist + 1e-10))
-    s_entropy = -np.sum(s_hist * np.log2(s_hist + 1e-10))
+    h_entropy = _entropy(h_counts)
+    s_entropy = _entropy(s_counts)
     
     # Normalize scores
     h_score = min(h_entropy / 7.0, 1.0)  # Max entropy ~7 for 180 bins
@@ -106,33 +168,28 @@ def analyze_color_diversity(image: np.ndarray) -> float:
     return (h_score + s_score) / 2.0
 
 
-def analyze_frequency(image: np.ndarray) -> float:
+def _entropy(counts: np.ndarray) -> float:
+    """Shannon entropy in bits of a histogram given as raw counts"""
+    # Empty bins contribute nothing, so only occupied ones are normalized
+    p = counts[counts > 0] / counts.sum()
+    return float(-np.sum(p * np.log2(p)))
+
+
+def analyze_frequency(spectrum: np.ndarray, width: int) -> float:
     """
     Analyze frequency domain. Screens and prints have characteristic
     frequency patterns (moiré patterns, pixel grids).
-    """
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    
-    # Apply FFT
-    f_transform = np.fft.fft2(gray)
-    f_shift = np.fft.fftshift(f_transform)
-    magnitude = np.abs(f_shift)
-    
-    # Analyze high-frequency content
-    rows, cols = magnitude.shape
-    crow, ccol = rows // 2, cols // 2
     
-    # Create mask for high frequencies (outer region)
-    mask = np.ones((rows, cols), dtype=np.uint8)
-    r = min(rows, cols) // 4
-    cv2.circle(mask, (ccol, crow), r, 0, -1)
-    
-    # Calculate high-frequency energy
-    high_freq_energy = np.sum(magnitude * mask)
-    total_energy = np.sum(magnitude)
+    Args:
+        spectrum: np.fft.rfft2 of the grayscale image (unshifted)
+        width: Width of the grayscale image
+    """
+    # Ratio of high-frequency energy (outside a centred disk) to the total
+    rows = spectrum.shape[0]
+    r = min(rows, width) // 4
     
     # Live faces typically have more high-frequency content
-    ratio = high_freq_energy / (total_energy + 1e-10)
+    ratio = _high_frequency_ratio(spectrum, r, width)
     
     # Normalize (typical range 0.3-0.7 for live, 0.1-0.3 for spoof)
     score = min(max((ratio - 0.1) / 0.4, 0.0), 1.0)
@@ -140,15 +197,19 @@ def analyze_frequency(image: np.ndarray) -> float:
     return score
 
 
-def analyze_sharpness(image: np.ndarray) -> float:
+def analyze_sharpness(laplacian: np.ndarray, scale: float = 1.0) -> float:
     """
     Analyze image sharpness. Blurry images might indicate
     a photo of a photo or screen capture.
-    """
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     
-    # Calculate Laplacian variance (measure of sharpness)
-    laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
+    Args:
+        laplacian: Laplacian of the grayscale image
+        scale: Factor the image was downsampled by before analysis
+    """
+    # Calculate Laplacian variance (measure of sharpness). Downsampling
+    # shrinks blur and raises the variance, so it is scaled back by the
+    # downsampling factor to keep blurry large frames from passing
+    laplacian_var = laplacian.var(dtype=np.float64) * scale
     
     # Normalize score (typical range: 100-1000 for sharp, <100 for blurry)
     score = min(laplacian_var / 500.0, 1.0)
@@ -0,0 +1,33 @@
+import threading
+import numpy as np
+from typing import Tuple
+
+class ScratchPool:
+    """
+    Named work arrays reused across calls on the same thread.
+
+    Each name holds one buffer, which is reallocated only when a different
+    shape or dtype is requested. Buffers are overwritten by the next call
+    asking for the same name, so they must never be returned to callers.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name: str, shape: Tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+        return buffer
+
+_local = threading.local()
+
+def get_scratch_pool() -> ScratchPool:
+    """Return the scratch pool of the calling thread"""
+    pool = getattr(_local, "pool", None)
+    if pool is None:
+        pool = _local.pool = ScratchPool()
+    return pool